@@ -1,79 +1,276 @@
 # file: forward_pair_webhook.py
 import os
-import json
+import hmac
 import logging
 import asyncio
-from typing import Optional, Dict
+from functools import lru_cache
+from itertools import groupby
+from operator import itemgetter
+from typing import Optional, Dict, List, Set
 
-from fastapi import FastAPI, Request, HTTPException
+import orjson
+from fastapi import FastAPI
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.routing import Route
 from telegram import Update
-from telegram.ext import (
-    Application, ApplicationBuilder,
-    CommandHandler, MessageHandler, ContextTypes, filters
-)
+from telegram.error import BadRequest, Forbidden, TelegramError
+from telegram.ext import CommandHandler, MessageHandler, TypeHandler, ContextTypes, filters
+
+from tg_client import tg_app
+
+try:  # при запуске через uvicorn цикл задаёт --loop / UVICORN_LOOP
+    import uvloop
+    uvloop.install()
+except ImportError:
+    pass
 
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger("pair-bot")
 
 # === ENV ===
-BOT_TOKEN = os.getenv("BOT_TOKEN")
 APP_BASE_URL = os.getenv("APP_BASE_URL")  # напр. https://tg-forward-bot.onrender.com
 WEBHOOK_SECRET_TOKEN = os.getenv("WEBHOOK_SECRET_TOKEN", "use-long-random")
 PORT = int(os.getenv("PORT", "10000"))
 PAIRS_FILE = os.getenv("PAIRS_FILE", "pairs.json")
+SECRET_BYTES = WEBHOOK_SECRET_TOKEN.encode()
+
+if not APP_BASE_URL:
+    raise SystemExit("Set APP_BASE_URL env var!")
 
-if not BOT_TOKEN or not APP_BASE_URL:
-    raise SystemExit("Set BOT_TOKEN and APP_BASE_URL env vars!")
+WEBHOOK_PATH = f"/webhook/{WEBHOOK_SECRET_TOKEN}"
+WEBHOOK_URL = APP_BASE_URL.rstrip("/") + WEBHOOK_PATH
 
 # === STORAGE (pairs) ===
-_pairs_lock = asyncio.Lock()
-_pairs: Dict[str, int] = {}  # "chat_id" -> partner_id (int)
+# pairs.json — снапшот, pairs.json.log — журнал операций (JSONL) поверх него
+PAIRS_LOG = PAIRS_FILE + ".log"
+COMPACT_EVERY = 1000  # после стольких операций журнал сворачивается в снапшот
+WRITE_DELAY = 0.05  # сек: окно, за которое пачка изменений уходит одной записью
 
-def _ensure_dir(path: str):
+_pairs: Dict[int, int] = {}  # chat_id -> partner_id (в JSON ключи строками)
+_pending_ops: List[bytes] = []  # ещё не записанные строки журнала
+_dirty = asyncio.Event()
+_writer_stop = False
+_writer_task: Optional[asyncio.Task] = None
+_log_fd: Optional[int] = None
+_log_ops = 0
+
+async def _ensure_dir(path: str):
     d = os.path.dirname(path)
-    if d and not os.path.exists(d):
-        os.makedirs(d, exist_ok=True)
+    if d:
+        await asyncio.to_thread(os.makedirs, d, exist_ok=True)
 
-async def load_pairs():
-    global _pairs
-    if not os.path.exists(PAIRS_FILE):
-        _pairs = {}
+def _read_bytes(path: str) -> Optional[bytes]:
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+def _write_snapshot(buf: bytes):
+    tmp = PAIRS_FILE + ".tmp"
+    # fsync только здесь (компакция/старт): снапшот должен быть на диске до
+    # truncate журнала; обычные дозаписи в журнал диск не синхронизируют
+    with open(tmp, "wb") as f:
+        f.write(buf)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, PAIRS_FILE)
+    # и сам rename: без fsync каталога после сбоя может вернуться старый снапшот
+    # (на Windows каталог так не открыть — там это не нужно и не поддерживается)
+    if os.name == "posix":
+        dir_fd = os.open(os.path.dirname(PAIRS_FILE) or ".", os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+def _apply_op(op: str, a: int, b: Optional[int]):
+    if op == "set":
+        _pairs[a] = b
+        _pairs[b] = a
+    elif op == "unlink":
+        _pairs.pop(a, None)
+        if b is not None:
+            _pairs.pop(b, None)
+
+async def _compact():
+    # вызывается только из писателя (или до его старта) — гонок с дозаписью нет
+    global _log_ops
+    buf = orjson.dumps(_pairs, option=orjson.OPT_NON_STR_KEYS)
+    await _ensure_dir(PAIRS_FILE)
+    await asyncio.to_thread(_write_snapshot, buf)
+    if _log_fd is not None:
+        os.ftruncate(_log_fd, 0)
+    elif os.path.exists(PAIRS_LOG):
+        os.truncate(PAIRS_LOG, 0)
+    _log_ops = 0
+
+async def _flush():
+    global _log_ops
+    if not _pending_ops:
         return
+    n = len(_pending_ops)
+    rest = memoryview(b"".join(_pending_ops))
+    _pending_ops.clear()
     try:
-        async with _pairs_lock:
-            with open(PAIRS_FILE, "r", encoding="utf-8") as f:
-                _pairs = {k: int(v) for k, v in json.load(f).items()}
+        while rest:  # os.write может записать не всё
+            rest = rest[os.write(_log_fd, rest):]
+    except Exception as e:
+        # недописанный хвост (в т.ч. конец оборванной строки) уйдёт следующей записью
+        _pending_ops.insert(0, bytes(rest))
+        log.exception("Failed to save pairs: %s", e)
+        return
+    _log_ops += n
+    if _log_ops >= COMPACT_EVERY:
+        try:
+            await _compact()
+        except Exception as e:
+            log.exception("Failed to compact pairs: %s", e)
+
+async def _writer_loop():
+    while not _writer_stop:
+        await _dirty.wait()
+        _dirty.clear()
+        await asyncio.sleep(WRITE_DELAY)
+        await _flush()
+    await _flush()
+
+def _append_op(op: str, a: int, b: Optional[int]):
+    _pending_ops.append(orjson.dumps({"op": op, "a": a, "b": b}) + b"\n")
+    _dirty.set()
+
+async def load_pairs():
+    global _pairs, _log_fd
+    loaded = False
+    try:
+        snapshot = await asyncio.to_thread(_read_bytes, PAIRS_FILE)
+        journal = await asyncio.to_thread(_read_bytes, PAIRS_LOG)
+        _pairs = {}
+        for k, v in (orjson.loads(snapshot).items() if snapshot else ()):
+            try:
+                _pairs[int(k)] = int(v)
+            except (ValueError, TypeError):
+                log.warning("Skipping broken pairs entry: %r -> %r", k, v)
+        for line in (journal or b"").splitlines():
+            try:
+                rec = orjson.loads(line)
+                op, a, b = rec["op"], int(rec["a"]), rec["b"]
+                b = None if b is None else int(b)
+                if op not in ("set", "unlink") or (op == "set" and b is None):
+                    raise ValueError(op)
+            except (ValueError, KeyError, TypeError):
+                log.warning("Skipping broken pairs log line: %r", line)
+                continue
+            _apply_op(op, a, b)
+        loaded = True
     except Exception as e:
         log.exception("Failed to load pairs: %s", e)
         _pairs = {}
-
-async def save_pairs():
+    if loaded:
+        # не вышло записать снапшот — не беда: журнал цел, пары остаются в памяти
+        try:
+            await _compact()
+        except Exception as e:
+            log.exception("Failed to compact pairs: %s", e)
     try:
-        async with _pairs_lock:
-            _ensure_dir(PAIRS_FILE)
-            with open(PAIRS_FILE, "w", encoding="utf-8") as f:
-                json.dump(_pairs, f, ensure_ascii=False, indent=2)
+        await _ensure_dir(PAIRS_LOG)
+        _log_fd = os.open(PAIRS_LOG, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
     except Exception as e:
-        log.exception("Failed to save pairs: %s", e)
+        log.exception("Failed to open pairs log: %s", e)
 
-async def get_partner(chat_id: int) -> Optional[int]:
-    return _pairs.get(str(chat_id))
+def start_pairs_writer():
+    global _writer_task, _writer_stop
+    _writer_stop = False
+    _writer_task = asyncio.create_task(_writer_loop())
 
-async def set_pair(a: int, b: int):
-    _pairs[str(a)] = b
-    _pairs[str(b)] = a
-    await save_pairs()
+async def close_pairs():
+    global _log_fd, _writer_stop
+    if _writer_task is not None:
+        _writer_stop = True
+        _dirty.set()
+        await _writer_task
+    if _log_fd is not None:
+        os.fsync(_log_fd)
+        os.close(_log_fd)
+        _log_fd = None
 
-async def unlink(a: int):
-    b = _pairs.pop(str(a), None)
+def get_partner(chat_id: int) -> Optional[int]:
+    return _pairs.get(chat_id)
+
+def set_pair(a: int, b: int):
+    _apply_op("set", a, b)
+    _append_op("set", a, b)
+
+def unlink(a: int):
+    b = _pairs.get(a)
     if b is not None:
-        _pairs.pop(str(b), None)
-    await save_pairs()
+        _apply_op("unlink", a, b)
+        _append_op("unlink", a, b)
     return b
 
 # === FASTAPI + PTB ===
 app = FastAPI()
-tg_app: Application = ApplicationBuilder().token(BOT_TOKEN).build()
+
+# === RELAY QUEUE ===
+# Пересылка идёт через очередь на каждый чат-получатель: всё, что успело
+# накопиться, уходит одним copyMessages вместо copyMessage на каждое сообщение.
+RELAY_BATCH_MAX = 100  # лимит message_ids в одном copyMessages
+RELAY_BATCH_WINDOW = 0.05  # сек: ждём, пока догонят остальные части «пачки»
+RELAY_DRAIN_TIMEOUT = 5  # сек: сколько ждать досылки очередей при остановке
+
+_send_queues: Dict[int, asyncio.Queue] = {}
+_send_workers: Dict[int, asyncio.Task] = {}
+
+async def _send_worker(to_chat: int, q: asyncio.Queue):
+    while True:
+        batch = [await q.get()]
+        await asyncio.sleep(RELAY_BATCH_WINDOW)
+        try:
+            while len(batch) < RELAY_BATCH_MAX:
+                batch.append(q.get_nowait())
+        except asyncio.QueueEmpty:
+            pass
+        for from_chat, group in groupby(batch, key=itemgetter(0)):
+            try:
+                await tg_app.bot.copy_messages(
+                    chat_id=to_chat,
+                    from_chat_id=from_chat,
+                    # copyMessages требует строго возрастающих id; повтор
+                    # (например, правка того же сообщения) копируем один раз
+                    message_ids=sorted({m for _, m in group}),
+                    protect_content=False
+                )
+            except (Forbidden, BadRequest) as e:
+                # партнёр заблокировал бота / сообщение нельзя скопировать — штатно
+                log.debug("relay skipped: %s", e)
+            except Exception as e:
+                log.exception("Forward error: %s", e)
+        for _ in batch:
+            q.task_done()
+        if q.empty():
+            # очередь опустела — выходим; enqueue_relay поднимет новый воркер
+            _send_queues.pop(to_chat, None)
+            _send_workers.pop(to_chat, None)
+            return
+
+def enqueue_relay(to_chat: int, from_chat: int, message_id: int):
+    q = _send_queues.get(to_chat)
+    if q is None:
+        q = _send_queues[to_chat] = asyncio.Queue()
+        _send_workers[to_chat] = asyncio.create_task(_send_worker(to_chat, q))
+    q.put_nowait((from_chat, message_id))
+
+async def close_relays():
+    joins = [asyncio.create_task(q.join()) for q in _send_queues.values()]
+    if joins:
+        await asyncio.wait(joins, timeout=RELAY_DRAIN_TIMEOUT)
+    workers = list(_send_workers.values())
+    for t in joins + workers:
+        t.cancel()
+    await asyncio.gather(*joins, *workers, return_exceptions=True)
+    _send_queues.clear()
+    _send_workers.clear()
 
 HELP_TEXT = (
     "Я связываю два аккаунта и пересылаю сообщения между ними.\n\n"
@@ -86,10 +283,35 @@ HELP_TEXT = (
     "Подсказка: Отправь <code>/link {cid}</code> — и вы будете связаны.\n"
 )
 
+# Чаты, которые сами писали боту: остальным Telegram не даст отправить сообщение,
+# поэтому уведомления им не шлём вовсе. Держится в памяти; на старте засеивается
+# всеми чатами из пар — неудачная отправка и так выкинет чат из набора.
+_reachable: Set[int] = set()
+
+async def track_reachable(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_chat:
+        _reachable.add(update.effective_chat.id)
+
+async def _notify(context: ContextTypes.DEFAULT_TYPE, chat_id: int, text: str, **kwargs):
+    if chat_id not in _reachable:
+        return
+    try:
+        await context.bot.send_message(chat_id, text, **kwargs)
+    except (Forbidden, BadRequest) as e:
+        _reachable.discard(chat_id)
+        log.debug("notify skipped: %s", e)
+    except TelegramError as e:
+        # сеть/таймаут/флуд-лимит: связь уже изменена, ответ пользователю важнее
+        log.exception("Notify error: %s", e)
+
+@lru_cache(maxsize=4096)
+def _help_for(cid: int) -> str:
+    return HELP_TEXT.format(cid=cid)
+
 async def start_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     cid = update.effective_chat.id
-    partner = await get_partner(cid)
-    msg = "👋 Привет! Я бот-«пересылатель».\n\n" + HELP_TEXT.format(cid=cid)
+    partner = get_partner(cid)
+    msg = "👋 Привет! Я бот-«пересылатель».\n\n" + _help_for(cid)
     if partner:
         msg += f"\n✅ Уже связан с: <code>{partner}</code>\nНапиши любое сообщение — я отправлю его партнёру."
     else:
@@ -102,7 +324,7 @@ async def myid_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def checklink_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     cid = update.effective_chat.id
-    partner = await get_partner(cid)
+    partner = get_partner(cid)
     if partner:
         await update.message.reply_html(f"Связь установлена с: <code>{partner}</code>")
     else:
@@ -124,17 +346,15 @@ async def link_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Нельзя связать самого себя 🙂")
         return
 
-    await set_pair(cid, other)
+    set_pair(cid, other)
 
-    try:
-        await context.bot.send_message(
-            other,
-            f"🔗 Вас связали с аккаунтом <code>{cid}</code>.\n"
-            f"Теперь сообщения будут пересылаться автоматически.",
-            parse_mode="HTML"
-        )
-    except Exception:
-        pass
+    await _notify(
+        context,
+        other,
+        f"🔗 Вас связали с аккаунтом <code>{cid}</code>.\n"
+        f"Теперь сообщения будут пересылаться автоматически.",
+        parse_mode="HTML"
+    )
 
     await update.message.reply_html(
         f"Готово! 🔗 Связал с <code>{other}</code>.\n"
@@ -144,12 +364,9 @@ async def link_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def unlink_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     cid = update.effective_chat.id
-    other = await unlink(cid)
+    other = unlink(cid)
     if other:
-        try:
-            await context.bot.send_message(other, "❌ Связь разорвана партнёром.")
-        except Exception:
-            pass
+        await _notify(context, other, "❌ Связь разорвана партнёром.")
         await update.message.reply_text("Связь разорвана.")
     else:
         await update.message.reply_text("Связи не было.")
@@ -157,62 +374,70 @@ async def unlink_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def relay_messages(update: Update, context: ContextTypes.DEFAULT_TYPE):
     msg = update.effective_message
     chat = update.effective_chat
-    if chat.type != "private":
-        return
-    if msg.from_user and msg.from_user.is_bot:
-        return
-
-    partner = await get_partner(chat.id)
+    partner = get_partner(chat.id)
     if not partner:
         await msg.reply_html(f"Связи пока нет. Сделай <code>/link {chat.id}</code> — и поехали.")
         return
 
-    try:
-        await context.bot.copy_message(
-            chat_id=partner,
-            from_chat_id=chat.id,
-            message_id=msg.message_id,
-            protect_content=False
-        )
-    except Exception as e:
-        log.exception("Forward error: %s", e)
+    enqueue_relay(partner, chat.id, msg.message_id)
 
 # === PTB handlers ===
+class _FromBot(filters.MessageFilter):
+    __slots__ = ()
+
+    def filter(self, message) -> bool:
+        return bool(message.from_user and message.from_user.is_bot)
+
+# приватные чаты, не команды и не от ботов — отсекается до вызова хендлера
+RELAY_FILTER = filters.ChatType.PRIVATE & ~filters.COMMAND & ~_FromBot(name="FROM_BOT")
+
+tg_app.add_handler(TypeHandler(Update, track_reachable), group=-1)
 tg_app.add_handler(CommandHandler("start", start_cmd))
 tg_app.add_handler(CommandHandler("myid", myid_cmd))
 tg_app.add_handler(CommandHandler("checklink", checklink_cmd))
 tg_app.add_handler(CommandHandler("link", link_cmd))
 tg_app.add_handler(CommandHandler("unlink", unlink_cmd))
-tg_app.add_handler(MessageHandler(filters.ALL & ~filters.COMMAND, relay_messages))
+tg_app.add_handler(MessageHandler(RELAY_FILTER, relay_messages))
 
 # === lifecycle ===
 @app.on_event("startup")
 async def on_startup():
     await load_pairs()
-    url = APP_BASE_URL.rstrip("/") + f"/webhook/{WEBHOOK_SECRET_TOKEN}"
+    _reachable.update(_pairs)
+    start_pairs_writer()
     await tg_app.bot.set_webhook(
-        url=url,
+        url=WEBHOOK_URL,
         secret_token=WEBHOOK_SECRET_TOKEN,
         allowed_updates=["message", "edited_message"],
         drop_pending_updates=True
     )
     await tg_app.initialize()
     await tg_app.start()
-    log.info("Webhook set to %s", url)
+    log.info("Webhook set to %s", WEBHOOK_URL)
 
 @app.on_event("shutdown")
 async def on_shutdown():
+    # stop() дожидается уже принятых апдейтов — они ещё могут класть в очереди пересылки
     await tg_app.stop()
+    await close_relays()
     await tg_app.shutdown()
+    await close_pairs()
 
-@app.post(f"/webhook/{WEBHOOK_SECRET_TOKEN}")
-async def telegram_webhook(req: Request):
-    if req.headers.get("x-telegram-bot-api-secret-token") != WEBHOOK_SECRET_TOKEN:
-        raise HTTPException(status_code=401, detail="Invalid secret token")
-    data = await req.json()
+# голый Starlette-роут: без dependency/pydantic-обвязки FastAPI на каждый POST
+async def telegram_webhook(req: Request) -> Response:
+    hdr = req.headers.get("x-telegram-bot-api-secret-token", "").encode()
+    if not hmac.compare_digest(hdr, SECRET_BYTES):
+        return Response(
+            b'{"detail":"Invalid secret token"}', status_code=401, media_type="application/json"
+        )
+    data = orjson.loads(await req.body())
     update = Update.de_json(data, tg_app.bot)
-    await tg_app.process_update(update)
-    return {"ok": True}
+    # отвечаем Telegram сразу; обработку (не больше MAX_CONCURRENT_UPDATES
+    # параллельно) ведёт сам PTB, разбирая update_queue
+    await tg_app.update_queue.put(update)
+    return Response(b'{"ok":true}', media_type="application/json")
+
+app.router.routes.append(Route(WEBHOOK_PATH, telegram_webhook, methods=["POST"]))
 
 @app.get("/healthz")
 async def healthz():
@@ -0,0 +1,23 @@
+# file: tg_client.py
+# Общий Application для всех модулей бота: один httpx-пул (HTTP/2) к api.telegram.org.
+# Модули-фичи только регистрируют свои хендлеры на tg_app.
+import os
+
+from telegram.ext import Application, ApplicationBuilder
+
+BOT_TOKEN = os.getenv("BOT_TOKEN")
+
+if not BOT_TOKEN:
+    raise SystemExit("Set BOT_TOKEN env var!")
+
+MAX_CONCURRENT_UPDATES = 256  # лимит PTB на апдейты из update_queue, обрабатываемые параллельно
+POOL_TIMEOUT = 5.0  # сек: ждать свободного соединения в пуле при всплеске
+
+tg_app: Application = (
+    ApplicationBuilder()
+    .token(BOT_TOKEN)
+    .concurrent_updates(MAX_CONCURRENT_UPDATES)
+    .http_version("2")
+    .pool_timeout(POOL_TIMEOUT)
+    .build()
+)